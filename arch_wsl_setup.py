@@ -14,21 +14,23 @@ import getpass
 import re
 import logging
 import time
+import random
 import signal
 import atexit
-import socket
+import threading
+import queue
+import shutil
+import pwd
+import shlex
 from pathlib import Path
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Callable, Any
+from typing import Dict, List, Optional, Callable, Any, Union
 from dataclasses import dataclass, field
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import wraps
+from collections import defaultdict, deque
+from functools import wraps, lru_cache
+from contextlib import nullcontext, contextmanager
 from enum import Enum
 
-# YAML 支持（由 bootstrap.sh 确保已安装）
-import yaml
-
-
 # ==========================================
 # 任务状态枚举
 # ==========================================
@@ -44,6 +46,25 @@ class TaskStatus(Enum):
 # ==========================================
 # 配置模块 - 支持外部化
 # ==========================================
+@lru_cache(maxsize=8)
+def _parse_config_file(path: str, mtime_ns: int, size: int) -> Any:
+    """解析 YAML 配置文件（进程内 LRU 缓存，以 mtime/size 校验；语法错误转为 ValueError）"""
+    # YAML 支持（由 bootstrap.sh 确保已安装）；延迟导入，仅在真正解析时加载
+    import yaml
+    
+    # 优先使用 LibYAML C 扩展解析（快 5~15 倍），不可用时回退到纯 Python 实现
+    try:
+        from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
+    
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            return yaml.load(f, Loader=YamlLoader)
+        except yaml.YAMLError as e:
+            raise ValueError(f"YAML 解析失败: {e}") from e
+
+
 class Cfg:
     """配置中心 - 从 YAML 文件加载所有配置"""
     
@@ -51,6 +72,17 @@ class Cfg:
     C = {'G': '\033[0;32m', 'B': '\033[0;34m', 'R': '\033[0;31m', 
          'Y': '\033[1;33m', 'C': '\033[0;36m', 'N': '\033[0m'}
     
+    # 可选配置项默认值（YAML 中未配置时生效）
+    NETWORK_CHECK_HOSTS: List[str] = []
+    PARALLEL_WORKERS: int = 4
+    RETRY_MAX_DELAY: int = 30
+    OMZ_REPO: str = "https://github.com/ohmyzsh/ohmyzsh.git"
+    YAY_REPO: str = "https://aur.archlinux.org/yay-bin.git"
+    PACMAN_USE_ARIA2: bool = False
+    
+    # pacman 包列表配置项（合并时按此顺序去重）
+    _PKG_KEYS = ('PKG_BASE', 'PKG_OPT', 'PKG_GH')
+    
     def __init__(self, config_file: str = "setup.yaml"):
         """初始化配置，从 YAML 文件加载"""
         self.config_file = config_file
@@ -71,25 +103,44 @@ class Cfg:
         
         # 加载 YAML 配置
         try:
-            with config_path.open('r', encoding='utf-8') as f:
-                config_data = yaml.safe_load(f)
-                
-                if not config_data:
-                    print(f"{self.C['R']}✗ 配置文件为空{self.C['N']}")
-                    sys.exit(1)
-                
-                # 将配置应用为类属性
-                for key, value in config_data.items():
-                    setattr(self, key, value)
-                
-                print(f"{self.C['G']}✓ 已加载配置文件: {self.config_file}{self.C['N']}")
-                
-        except yaml.YAMLError as e:
-            print(f"{self.C['R']}✗ YAML 解析失败: {e}{self.C['N']}")
+            st = config_path.stat()
+            config_data = _parse_config_file(str(config_path.resolve()), st.st_mtime_ns, st.st_size)
+            
+            if not config_data:
+                print(f"{self.C['R']}✗ 配置文件为空{self.C['N']}")
+                sys.exit(1)
+            
+            # 将配置应用为类属性
+            for key, value in config_data.items():
+                setattr(self, key, value)
+            
+            self._build_env()
+            
+            print(f"{self.C['G']}✓ 已加载配置文件: {self.config_file}{self.C['N']}")
+            
+        except ValueError as e:
+            print(f"{self.C['R']}✗ {e}{self.C['N']}")
             sys.exit(1)
         except Exception as e:
             print(f"{self.C['R']}✗ 配置文件加载失败: {e}{self.C['N']}")
             sys.exit(1)
+    
+    def _pkg_union(self, pkg_keys) -> tuple:
+        """多个包列表配置项的去重并集（保持配置顺序）"""
+        return tuple(dict.fromkeys(
+            pkg for key in self._PKG_KEYS if key in pkg_keys for pkg in getattr(self, key, None) or ()
+        ))
+    
+    def pkgs_for(self, features) -> tuple:
+        """指定功能（key）所需 pacman 包的去重并集"""
+        return self._pkg_union({Registry.get(key).pkg_key for key in features})
+    
+    def _build_env(self):
+        """构建子进程环境变量（含代理），加载配置时只构建一次"""
+        self.env = os.environ.copy()
+        if getattr(self, 'PROXY', None):
+            for key in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'):
+                self.env[key] = self.PROXY
 
 
 # ==========================================
@@ -98,22 +149,25 @@ class Cfg:
 class CleanupManager:
     """清理管理器：统一管理需要清理的临时文件/目录"""
     
-    _instance = None
-    _cleanup_items: List[Dict[str, Any]] = []
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+    def __init__(self):
+        self._cleanup_items: Dict[str, Dict[str, Any]] = {}  # 以路径为键
+        self._lock = threading.Lock()
     
     def register(self, path: str, item_type: str = "file", user: str = None, description: str = ""):
         """注册需要清理的项目"""
-        self._cleanup_items.append({
-            "path": path,
-            "type": item_type,  # file | dir
-            "user": user,
-            "description": description
-        })
+        with self._lock:
+            self._cleanup_items[path] = {
+                "path": path,
+                "type": item_type,  # file | dir
+                "user": user,
+                "description": description
+            }
+    
+    def unregister(self, *paths: str):
+        """移除已注册的项目（安装成功后调用）"""
+        with self._lock:
+            for path in paths:
+                self._cleanup_items.pop(path, None)
     
     def cleanup(self, force: bool = False):
         """执行清理"""
@@ -123,63 +177,76 @@ class CleanupManager:
         logger = get_logger()
         logger.log("\n🧹 正在清理临时文件...", 'INFO', 'Y')
         
-        for item in self._cleanup_items:
-            path = item["path"]
-            if not os.path.exists(path):
-                continue
+        # 按 (用户, 类型) 分组，每组只调用一次 rm（无 shell）
+        groups = defaultdict(list)
+        with self._lock:
+            items = list(self._cleanup_items.values())
+        for item in items:
+            if os.path.exists(item["path"]):
+                groups[(item["user"], item["type"])].append(item)
+        
+        for (user, item_type), items in groups.items():
+            argv = ["rm", "-rf" if item_type == "dir" else "-f", "--", *(item["path"] for item in items)]
+            if user:
+                argv = ["runuser", "-u", user, "--", *argv]
             
             try:
-                if item["type"] == "dir":
-                    cmd = f"rm -rf {path}"
-                else:
-                    cmd = f"rm -f {path}"
-                
-                if item["user"]:
-                    subprocess.run(f"su - {item['user']} -c '{cmd}'", 
-                                 shell=True, check=False, capture_output=True)
-                else:
-                    subprocess.run(cmd, shell=True, check=False, capture_output=True)
-                
+                subprocess.run(argv, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except Exception as e:
+                for item in items:
+                    logger.log(f"  ⚠ 无法删除 {item['path']}: {e}", 'WARNING', 'Y')
+                continue
+            
+            for item in items:
+                path = item["path"]
+                if os.path.exists(path):
+                    logger.log(f"  ⚠ 无法删除 {path}", 'WARNING', 'Y')
+                    continue
                 desc = f" ({item['description']})" if item['description'] else ""
                 logger.log(f"  ✓ 已删除: {path}{desc}", 'INFO', 'G')
-            except Exception as e:
-                logger.log(f"  ⚠ 无法删除 {path}: {e}", 'WARNING', 'Y')
         
-        self._cleanup_items.clear()
+        self.clear()
         logger.log("✓ 清理完成\n", 'INFO', 'G')
+        logger.flush()
     
     def clear(self):
         """清空清理列表（不执行清理）"""
-        self._cleanup_items.clear()
+        with self._lock:
+            self._cleanup_items.clear()
+
 
+_cleanup_mgr = None
 
 def get_cleanup_manager() -> CleanupManager:
     """获取全局清理管理器"""
-    return CleanupManager()
+    global _cleanup_mgr
+    if _cleanup_mgr is None:
+        _cleanup_mgr = CleanupManager()
+    return _cleanup_mgr
 
 
 # ==========================================
 # 任务结果跟踪器
 # ==========================================
+_ANSI_RE = re.compile(r"\033\[[0-9;]*m")
+
+
 class TaskTracker:
     """任务结果跟踪器：记录所有任务的执行状态"""
     
-    _instance = None
-    _tasks: List[Dict[str, Any]] = []
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super().__new__(cls)
-        return cls._instance
+    def __init__(self):
+        self._tasks: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
     
     def record(self, name: str, status: TaskStatus, message: str = "", duration: float = 0):
-        """记录任务结果"""
-        self._tasks.append({
-            "name": name,
-            "status": status,
-            "message": message,
-            "duration": duration
-        })
+        """记录任务结果（线程安全）"""
+        with self._lock:
+            self._tasks.append({
+                "name": name,
+                "status": status,
+                "message": message,
+                "duration": duration
+            })
     
     def print_summary(self):
         """打印结果摘要表格"""
@@ -187,14 +254,7 @@ class TaskTracker:
             return
         
         cfg = get_config()
-        log("\n" + "="*80, 'B')
-        log("  📊 执行结果摘要", 'B')
-        log("="*80, 'B')
-        
-        # 表头
-        header = f"{'任务名称':<30} {'状态':<10} {'耗时':<10} {'备注'}"
-        log(header, 'C')
-        log("-"*80, 'C')
+        C = cfg.C
         
         # 统计
         success_count = sum(1 for t in self._tasks if t['status'] == TaskStatus.SUCCESS)
@@ -202,33 +262,44 @@ class TaskTracker:
         failed_count = sum(1 for t in self._tasks if t['status'] == TaskStatus.FAILED)
         total_duration = sum(t['duration'] for t in self._tasks)
         
+        # 先拼接完整表格，最后一次性输出（避免逐行写入，且不会与并发日志交错）
+        rows = [
+            f"{C['B']}\n{'='*80}{C['N']}",
+            f"{C['B']}  📊 执行结果摘要{C['N']}",
+            f"{C['B']}{'='*80}{C['N']}",
+            f"{C['C']}{'任务名称':<30} {'状态':<10} {'耗时':<10} {'备注'}{C['N']}",
+            f"{C['C']}{'-'*80}{C['N']}",
+        ]
+        
         # 表格内容
         for task in self._tasks:
-            status_display = {
-                TaskStatus.SUCCESS: f"{cfg.C['G']}✓ {task['status'].value}{cfg.C['N']}",
-                TaskStatus.SKIPPED: f"{cfg.C['Y']}○ {task['status'].value}{cfg.C['N']}",
-                TaskStatus.FAILED: f"{cfg.C['R']}✗ {task['status'].value}{cfg.C['N']}"
-            }
-            
-            status_str = status_display.get(task['status'], task['status'].value)
             duration_str = f"{task['duration']:.1f}s" if task['duration'] > 0 else "-"
             message_str = task['message'][:30] if task['message'] else "-"
-            
-            # 直接打印（绕过日志系统以保持格式）
-            print(f"{task['name']:<30} {task['status'].value:<10} {duration_str:<10} {message_str}")
-        
-        log("-"*80, 'C')
-        log(f"总计: {len(self._tasks)} 个任务 | "
-            f"{cfg.C['G']}成功: {success_count}{cfg.C['N']} | "
-            f"{cfg.C['Y']}跳过: {skipped_count}{cfg.C['N']} | "
-            f"{cfg.C['R']}失败: {failed_count}{cfg.C['N']} | "
-            f"总耗时: {total_duration:.1f}s", 'C')
-        log("="*80 + "\n", 'B')
+            rows.append(f"{task['name']:<30} {task['status'].value:<10} {duration_str:<10} {message_str}")
+        
+        rows.append(f"{C['C']}{'-'*80}{C['N']}")
+        rows.append(f"{C['C']}总计: {len(self._tasks)} 个任务 | "
+                    f"{C['G']}成功: {success_count}{C['N']} | "
+                    f"{C['Y']}跳过: {skipped_count}{C['N']} | "
+                    f"{C['R']}失败: {failed_count}{C['N']} | "
+                    f"{C['C']}总耗时: {total_duration:.1f}s{C['N']}")
+        rows.append(f"{C['B']}{'='*80}\n{C['N']}")
+        
+        summary = "\n".join(rows)
+        plain = _ANSI_RE.sub("", summary)
+        logger = get_logger()
+        logger.console((summary if logger.colored else plain) + "\n")
+        logger.logger.info(plain)
+
 
+_task_tracker = None
 
 def get_task_tracker() -> TaskTracker:
     """获取全局任务跟踪器"""
-    return TaskTracker()
+    global _task_tracker
+    if _task_tracker is None:
+        _task_tracker = TaskTracker()
+    return _task_tracker
 
 
 # ==========================================
@@ -242,26 +313,59 @@ class Context:
     shell: str = "/bin/zsh"
     enable_systemd: bool = True
     user_home: str = ""
+    pacman_install: Optional["AggregatedPacmanInstall"] = None
+    selected: frozenset = frozenset()  # 本次选中的功能 key
+    db_synced: bool = False  # 同步数据库是否已在本次运行中刷新过
+    _home_cache: Dict[str, str] = field(default_factory=dict, init=False, repr=False)
     
     def __post_init__(self):
         if self.username:
             self.user_home = self._get_home()
     
     def _get_home(self) -> str:
-        r = subprocess.run(f"eval echo ~{self.username}", shell=True, 
-                          capture_output=True, text=True)
-        return r.stdout.strip()
+        """用户 home 目录（按用户名缓存；用户尚不存在时返回空串且不缓存）"""
+        home = self._home_cache.get(self.username)
+        if home is None:
+            try:
+                home = self._home_cache[self.username] = pwd.getpwnam(self.username).pw_dir
+            except KeyError:
+                return ""
+        return home
 
 
 # ==========================================
 # 日志系统 - 持久化
 # ==========================================
+# 日志级别名 -> logging 数值级别
+_LEVEL_MAP = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO,
+              'WARNING': logging.WARNING, 'ERROR': logging.ERROR}
+
+# 颜色 -> 日志级别名
+_COLOR_LEVELS = {'R': 'ERROR', 'Y': 'WARNING', 'G': 'INFO', 'B': 'INFO', 'C': 'INFO', 'N': 'INFO'}
+
+
 class DualLogger:
     """双输出日志系统：同时输出到控制台和文件"""
     
     def __init__(self, log_file: str):
         self.logger = logging.getLogger('ArchWSL')
         self.logger.setLevel(logging.DEBUG)
+        self._buffer = None
+        self._queue_handler = None
+        self._listener = None
+        self._file_log = self.logger.log
+        self._colors = Cfg.C
+        self._reset = Cfg.C['N']
+        # 输出被重定向到文件/管道时不写 ANSI 颜色码（只在启动时检测一次）
+        self.colored = sys.stdout.isatty()
+        
+        # 控制台输出由后台线程写终端，调用方只入队（终端渲染慢时不阻塞功能执行）
+        self._console = queue.SimpleQueue()
+        self._console_thread = threading.Thread(
+            target=self._console_writer, args=(self._console,), name="console-writer", daemon=True
+        )
+        self._console_thread.start()
+        atexit.register(self.close)
         
         # 文件处理器
         try:
@@ -272,19 +376,124 @@ class DualLogger:
                 '%(asctime)s [%(levelname)s] %(message)s',
                 datefmt='%Y-%m-%d %H:%M:%S'
             ))
-            self.logger.addHandler(fh)
+            
+            # 缓冲写入：攒满 256 条或遇到 ERROR 时才落盘，退出时强制刷新
+            from logging.handlers import MemoryHandler, QueueHandler, QueueListener
+            self._buffer = MemoryHandler(
+                capacity=256, flushLevel=logging.ERROR, target=fh
+            )
+            
+            # 异步写入：调用方只入队，由后台线程写文件
+            log_queue = queue.Queue(-1)
+            self._queue_handler = QueueHandler(log_queue)
+            self._listener = QueueListener(log_queue, self._buffer)
+            self.logger.addHandler(self._queue_handler)
+            self._listener.start()
         except Exception as e:
             print(f"警告：无法创建日志文件 {log_file}: {e}")
     
-    def log(self, msg: str, level: str = 'INFO', color: str = 'N'):
-        """同时输出到控制台和文件"""
-        cfg = get_config()
-        # 控制台输出（带颜色）
-        print(f"{cfg.C[color]}{msg}{cfg.C['N']}")
+    def log(self, msg: str, level: str = 'INFO', color: str = 'N', *args):
+        """同时输出到控制台和文件；传入 args 时按 msg % args 格式化（只格式化一次）"""
+        if args:
+            msg = msg % args
+        
+        # 控制台输出（终端下带颜色）
+        if self.colored:
+            self.console(f"{self._colors[color]}{msg}{self._reset}\n")
+        else:
+            self.console(msg + "\n")
         
         # 文件输出（无颜色）
-        log_func = getattr(self.logger, level.lower(), self.logger.info)
-        log_func(msg)
+        self._file_log(_LEVEL_MAP.get(level, logging.INFO), msg)
+    
+    def console(self, text: str):
+        """原样输出到控制台（不写日志文件）；后台线程已停止时直接写出"""
+        console = self._console
+        if console is not None:
+            console.put(text)
+        else:
+            self._write(text)
+    
+    @staticmethod
+    def _write(text: str):
+        """直接写控制台；stdout 已不可写（如管道读端已退出）时丢弃输出"""
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass
+    
+    def _console_writer(self, console: queue.SimpleQueue):
+        """后台线程：按入队顺序写终端；遇到 Event 表示有人等待排空，None 表示退出
+        
+        每次取出队列中已积压的全部输出，合并为一次 write + flush，
+        密集输出（镜像列表、插件结果）时系统调用数随批次而非行数增长。
+        线程因任何原因退出后，console() 改为直接写出，队列中等待排空的调用方全部唤醒。
+        """
+        text = []
+        
+        def emit():
+            if text:
+                self._write("".join(text))
+                text.clear()
+        
+        try:
+            while True:
+                items = [console.get()]
+                while not console.empty():
+                    items.append(console.get())
+                
+                for item in items:
+                    if isinstance(item, str):
+                        text.append(item)
+                        continue
+                    emit()
+                    if item is None:
+                        return
+                    item.set()
+                emit()
+        finally:
+            self._console = None
+            while not console.empty():
+                item = console.get()
+                if isinstance(item, str):
+                    self._write(item)
+                elif item is not None:
+                    item.set()
+    
+    def flush_console(self):
+        """等待已入队的控制台输出全部写出（读取输入或子进程直接占用终端前调用）"""
+        console = self._console
+        if console is not None:
+            done = threading.Event()
+            console.put(done)
+            # 写线程已退出时不再等待（其退出前未处理到的 Event 不会被 set）
+            while not done.wait(0.5):
+                if not self._console_thread.is_alive():
+                    break
+    
+    def flush(self):
+        """将队列及缓冲中的日志写入文件"""
+        if self._listener:
+            # stop() 会处理完队列中剩余的记录，随后重新启动后台线程
+            self._listener.stop()
+            self._listener.start()
+        if self._buffer:
+            self._buffer.flush()
+    
+    def close(self):
+        """停止后台写入线程；之后的日志改为同步写入，保证退出阶段的日志不丢失"""
+        if self._console is not None:
+            console, self._console = self._console, None
+            console.put(None)
+            self._console_thread.join()
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+            self.logger.removeHandler(self._queue_handler)
+            self.logger.addHandler(self._buffer)
+        if self._buffer:
+            self._buffer.flush()
 
 # 全局实例
 _logger = None
@@ -306,6 +515,75 @@ def get_config() -> Cfg:
     return _cfg
 
 
+# ==========================================
+# 中断控制 - 信号到达后停止调度并终止子进程
+# ==========================================
+class InstallCancelled(BaseException):
+    """安装已被中断（继承 BaseException，不会被功能内部的 except Exception 吞掉，也不会触发重试）"""
+
+
+_CANCEL = threading.Event()
+# 在途子进程 -> 是否运行在独立进程组；信号处理器在主线程中获取，使用可重入锁避免自锁
+_CHILDREN: Dict[subprocess.Popen, bool] = {}
+_CHILDREN_LOCK = threading.RLock()
+
+
+def check_cancelled():
+    """已中断时抛出 InstallCancelled"""
+    if _CANCEL.is_set():
+        raise InstallCancelled("安装已中断")
+
+
+def _signal_child(proc: subprocess.Popen, group: bool, sig: int):
+    """向子进程（group=True 时为整个进程组）发送信号，进程已退出时忽略"""
+    if proc.poll() is not None:
+        return
+    try:
+        if group:
+            os.killpg(proc.pid, sig)
+        else:
+            proc.send_signal(sig)
+    except ProcessLookupError:
+        pass
+
+
+@contextmanager
+def _spawn(args, group: bool = False, **kwargs):
+    """启动并登记子进程，中断时由 cancel_all() 统一终止；子进程结束后若已中断则抛出 InstallCancelled
+    
+    group=True 时子进程在独立会话中运行（不接收终端的 Ctrl+C），中断时按进程组终止；
+    仅用于不使用终端的子进程。
+    """
+    check_cancelled()
+    with subprocess.Popen(args, start_new_session=group, **kwargs) as proc:
+        with _CHILDREN_LOCK:
+            _CHILDREN[proc] = group
+        try:
+            # 登记前已中断时 cancel_all() 看不到该进程，由这里自行终止
+            if _CANCEL.is_set():
+                _signal_child(proc, group, signal.SIGTERM)
+            yield proc
+        finally:
+            with _CHILDREN_LOCK:
+                _CHILDREN.pop(proc, None)
+    check_cancelled()
+
+
+def cancel_all(timeout: float = 5):
+    """标记中断并终止全部在途子进程（先 SIGTERM，超时后 SIGKILL）"""
+    _CANCEL.set()
+    with _CHILDREN_LOCK:
+        children = list(_CHILDREN.items())
+    for proc, group in children:
+        _signal_child(proc, group, signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    for proc, group in children:
+        try:
+            proc.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            _signal_child(proc, group, signal.SIGKILL)
+
+
 # ==========================================
 # 重试装饰器 - 网络操作容错
 # ==========================================
@@ -328,8 +606,14 @@ def retry(times: int = None, delay: int = None,
                     if attempt < _times:
                         logger = get_logger()
                         logger.log(f"⚠ 第 {attempt} 次尝试失败: {e}", 'WARNING', 'Y')
-                        logger.log(f"⏳ {_delay} 秒后重试...", 'INFO', 'Y')
-                        time.sleep(_delay)
+                        # 指数退避 + 随机抖动，上限为 RETRY_MAX_DELAY
+                        wait = min(_delay * (2 ** (attempt - 1)), cfg.RETRY_MAX_DELAY)
+                        wait *= random.uniform(0.5, 1.5)
+                        logger.log(f"⏳ {wait:.1f} 秒后重试...", 'INFO', 'Y')
+                        # 退避期间收到中断立即停止，不再重试
+                        _CANCEL.wait(wait)
+                        check_cancelled()
+                        bust_network_cache()
                     else:
                         logger = get_logger()
                         logger.log(f"✗ 失败 {_times} 次，放弃: {e}", 'ERROR', 'R')
@@ -341,30 +625,177 @@ def retry(times: int = None, delay: int = None,
 # ==========================================
 # 工具函数 - 无状态的纯函数
 # ==========================================
+_MASK_CHPASSWD = re.compile(r"(echo\s+['\"])[^:]+:([^'\"]+)(['\"].*chpasswd)")
+_MASK_SUDO = re.compile(r"(echo\s+['\"])([^'\"]+)(['\"].*sudo\s+-S)")
+
+
 def mask_sensitive_info(cmd: str) -> str:
     """脱敏敏感信息（密码等）"""
+    # 绝大多数命令不含敏感信息，先用子串判断快速返回
+    if "chpasswd" not in cmd and "sudo -S" not in cmd:
+        return cmd
     # 屏蔽 chpasswd 中的密码
-    cmd = re.sub(r"(echo\s+['\"])[^:]+:([^'\"]+)(['\"].*chpasswd)", r"\1***:***\3", cmd)
+    cmd = _MASK_CHPASSWD.sub(r"\1***:***\3", cmd)
     # 屏蔽 sudo -S 中的密码
-    cmd = re.sub(r"(echo\s+['\"])([^'\"]+)(['\"].*sudo\s+-S)", r"\1***\3", cmd)
+    cmd = _MASK_SUDO.sub(r"\1***\3", cmd)
     return cmd
 
 
+def _probe_host(host: str, port: int, timeout: int) -> bool:
+    """尝试与单个主机建立 TCP 连接"""
+    import socket
+    
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except (socket.timeout, socket.error, OSError):
+        return False
+
+
+# 网络探测结果缓存：(主机列表, 端口) -> (探测时间, 结果)
+_NET_CACHE: Dict[tuple, tuple] = {}
+_NET_CACHE_TTL = 30
+
+
+def bust_network_cache():
+    """清空网络探测缓存（重试前调用，避免网络恢复后仍命中旧的失败结果）"""
+    _NET_CACHE.clear()
+
+
 def check_network_connectivity(host: str = None, port: int = None, timeout: int = None) -> bool:
-    """检查网络连通性"""
+    """检查网络连通性（多个主机并发探测，任一成功即返回；结果缓存 30 秒）"""
     cfg = get_config()
-    host = host or cfg.NETWORK_CHECK_HOST
+    hosts = [host] if host else (cfg.NETWORK_CHECK_HOSTS or [cfg.NETWORK_CHECK_HOST])
     port = port or cfg.NETWORK_CHECK_PORT
     timeout = timeout or cfg.NETWORK_CHECK_TIMEOUT
     
+    key = (tuple(hosts), port)
+    cached = _NET_CACHE.get(key)
+    if cached and time.monotonic() - cached[0] < _NET_CACHE_TTL:
+        return cached[1]
+    
+    if len(hosts) == 1:
+        result = _probe_host(hosts[0], port, timeout)
+    else:
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        executor = ThreadPoolExecutor(max_workers=len(hosts))
+        try:
+            futures = [executor.submit(_probe_host, h, port, timeout) for h in hosts]
+            result = any(future.result() for future in as_completed(futures))
+        finally:
+            # 首个成功后不再等待其余探测
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    _NET_CACHE[key] = (time.monotonic(), result)
+    return result
+
+
+@lru_cache(maxsize=None)
+def url_opener():
+    """HTTP(S) 请求器（按配置走代理），进程内共享"""
+    import urllib.request
+    cfg = get_config()
+    proxy_handlers = [urllib.request.ProxyHandler({'http': cfg.PROXY, 'https': cfg.PROXY})] if cfg.PROXY else []
+    return urllib.request.build_opener(*proxy_handlers)
+
+
+@retry(times=3, delay=2)
+def download(url: str, dest: Union[str, Path], user: str = None, chunk_size: int = 64 * 1024) -> str:
+    """在进程内下载文件（分块流式写入并计算 sha256），返回 sha256 十六进制摘要
+    
+    先写临时文件再原子替换，失败时不会留下半截文件；指定 user 时将文件属主改为该用户。
+    """
+    import hashlib
+    dest = Path(dest)
+    tmp_path = dest.with_name(f"{dest.name}.{os.getpid()}.part")
+    digest = hashlib.sha256()
+    
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        sock.connect((host, port))
-        sock.close()
-        return True
-    except (socket.timeout, socket.error, OSError):
-        return False
+        with url_opener().open(url, timeout=30) as resp, tmp_path.open('wb') as f:
+            for chunk in iter(lambda: resp.read(chunk_size), b""):
+                check_cancelled()
+                digest.update(chunk)
+                f.write(chunk)
+        if user:
+            pw = pwd.getpwnam(user)
+            os.chown(tmp_path, pw.pw_uid, pw.pw_gid)
+        os.replace(tmp_path, dest)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    
+    get_logger().logger.debug(f"下载完成: {url} -> {dest} (sha256: {digest.hexdigest()})")
+    return digest.hexdigest()
+
+
+PACMAN_LOCAL_DB = "/var/lib/pacman/local"
+PACMAN_CONF = "/etc/pacman.conf"
+PACMAN_GNUPG = "/etc/pacman.d/gnupg"
+
+
+def install_packages(pkgs: List[str]) -> List[str]:
+    """批量安装失败后的重试：先统一预下载，再二分重试，返回最终安装失败的包"""
+    # 预下载全部安装包（pacman 按 ParallelDownloads 并行下载），后续安装直接读缓存
+    run(["pacman", "-Sw", "--noconfirm", "--disable-download-timeout", *pkgs], check=False, stream=True)
+    return _bisect_install(pkgs)
+
+
+def _bisect_install(pkgs: List[str]) -> List[str]:
+    """整批安装，失败则对半拆分递归重试，只在单个包时才判定失败"""
+    try:
+        run(["pacman", "-S", "--noconfirm", *pkgs], stream=True)
+        return []
+    except Exception:
+        if len(pkgs) == 1:
+            return list(pkgs)
+    mid = len(pkgs) // 2
+    return _bisect_install(pkgs[:mid]) + _bisect_install(pkgs[mid:])
+
+
+class AggregatedPacmanInstall:
+    """合并安装：把多个已选功能所需的包放进一次 pacman 事务
+    
+    首个调用 install() 的功能安装全部包（只读取一次同步数据库、解析一次依赖），
+    之后的调用直接返回同一结果。事务前缺失的包会被记录，
+    后执行的功能据此把已由本事务装好的包视为自己的安装结果，而不是"已安装，跳过"。
+    """
+    
+    def __init__(self, pkgs: List[str]):
+        self.pkgs = list(dict.fromkeys(pkgs))  # 去重并保持顺序
+        self._lock = threading.Lock()
+        self._failed: Optional[List[str]] = None
+        self._missing: Optional[frozenset] = None  # 事务执行前尚未安装的包
+    
+    def install(self) -> List[str]:
+        """执行合并安装（仅一次），返回安装失败的包"""
+        with self._lock:
+            if self._failed is None:
+                self._failed = self._install()
+            return self._failed
+    
+    def missing(self, pkgs: List[str]) -> List[str]:
+        """pkgs 中需要本次运行安装的包（事务已执行时按事务前的状态判断，含已由本事务装好的包）"""
+        with self._lock:
+            if self._missing is not None:
+                return [pkg for pkg in pkgs if pkg in self._missing]
+        return [pkg for pkg in pkgs if not pkg_installed(pkg)]
+    
+    def _install(self) -> List[str]:
+        pkgs = [pkg for pkg in self.pkgs if not pkg_installed(pkg)]
+        self._missing = frozenset(pkgs)
+        if not pkgs:
+            return []
+        
+        log(f"正在合并安装 {len(pkgs)} 个包...", 'G')
+        try:
+            run(["pacman", "-S", "--needed", "--noconfirm", *pkgs], stream=True)
+            return []
+        except subprocess.CalledProcessError:
+            log("⚠ 批量安装失败，尝试分批重试...", 'Y')
+            return install_packages(pkgs)
+        finally:
+            # 新装的包可能带来新命令，两处缓存都需失效
+            cached_pkg_set.cache_clear()
+            exists.cache_clear()
 
 
 def check_and_remove_pacman_lock() -> bool:
@@ -382,8 +813,15 @@ def check_and_remove_pacman_lock() -> bool:
             content = f.read().strip()
             if content.isdigit():
                 pid = int(content)
-                # 检查进程是否存在
-                if Path(f"/proc/{pid}").exists():
+                # 检查进程是否存在（信号 0 只做存在性检查；EPERM 说明进程存在但不属于当前用户）
+                try:
+                    os.kill(pid, 0)
+                    alive = True
+                except ProcessLookupError:
+                    alive = False
+                except PermissionError:
+                    alive = True
+                if alive:
                     log(f"  锁文件对应的进程 {pid} 仍在运行，无法自动清理", 'R')
                     return False
     except Exception:
@@ -399,45 +837,192 @@ def check_and_remove_pacman_lock() -> bool:
         return False
 
 
+# pacman/makepkg 共用 db.lck，同一时刻只允许一个运行；功能并发执行时在 run() 中串行化
+_PACMAN_LOCK = threading.Lock()
+_PACMAN_CMD_RE = re.compile(r"\b(?:pacman|makepkg)\b")
+
+# 含以下字符的命令需交由 shell 解释（管道、重定向、变量、通配符、多行脚本等）
+_SHELL_META = frozenset("|&;<>$`\\*?()[]{}~#\n")
+
+
+def _to_argv(cmd: Union[str, List[str]]) -> Optional[List[str]]:
+    """将命令转换为 argv 列表；需要 shell 解释时返回 None"""
+    if isinstance(cmd, (list, tuple)):
+        return list(cmd)
+    if _SHELL_META.isdisjoint(cmd):
+        return shlex.split(cmd)
+    return None
+
+
 @retry(times=3, delay=2)
-def run(cmd: str, user: str = None, check: bool = True, mask_log: bool = True) -> subprocess.CompletedProcess:
-    """执行命令（带敏感信息脱敏）"""
+def run(cmd: Union[str, List[str]], user: str = None, check: bool = True,
+        mask_log: bool = True, capture: bool = False, stream: bool = False,
+        extra_env: Dict[str, str] = None, input: str = None) -> subprocess.CompletedProcess:
+    """执行命令（带敏感信息脱敏）
+    
+    cmd 为列表或不含 shell 元字符的字符串时直接 exec，不经过 /bin/sh；
+    否则回退到 shell 执行。
+    capture=True 时捕获输出（stderr 合并到 stdout，未传 input 时 stdin 指向 /dev/null），
+    否则子进程直接继承终端输出。
+    stream=True 时逐行转发输出到控制台和日志文件，仅保留最后 500 行作为 stdout，
+    适用于输出量大的长时间命令（pacman、makepkg）。
+    extra_env 用于为单个命令追加环境变量。
+    input 经 stdin 传给子进程（不出现在命令行与 /proc/<pid>/cmdline 中，用于传递密码）。
+    以其他用户身份执行 shell 命令时使用 su - 登录环境，代理与 extra_env 会在命令前重新导出。
+    子进程均经 _spawn() 登记，中断后不再启动新命令，已中断的命令抛出 InstallCancelled 而不重试。
+    """
     logger = get_logger()
     cfg = get_config()
     
     # 日志记录（脱敏）
-    log_cmd = mask_sensitive_info(cmd) if mask_log else cmd
+    cmd_str = cmd if isinstance(cmd, str) else shlex.join(cmd)
+    log_cmd = mask_sensitive_info(cmd_str) if mask_log else cmd_str
     logger.logger.debug(f"执行命令: {log_cmd}" + (f" (用户: {user})" if user else ""))
     
-    # 设置环境变量（代理）
-    env = os.environ.copy()
-    if cfg.PROXY:
-        env['http_proxy'] = cfg.PROXY
-        env['https_proxy'] = cfg.PROXY
-        env['HTTP_PROXY'] = cfg.PROXY
-        env['HTTPS_PROXY'] = cfg.PROXY
+    # 调用 pacman 的命令全局互斥，其余命令不受影响
+    with _PACMAN_LOCK if _PACMAN_CMD_RE.search(cmd_str) else nullcontext():
+        # 环境变量（代理已在加载配置时设置）
+        env = {**cfg.env, **extra_env} if extra_env else cfg.env
+        
+        # 执行命令：优先直接 exec，避免额外的 shell 进程
+        argv = _to_argv(cmd)
+        if argv is not None:
+            if user:
+                argv = ["runuser", "-u", user, "--", *argv]
+            args, shell = argv, False
+        elif user:
+            # su - 会重置环境变量，在命令前重新导出代理与额外变量
+            exports = {**({key: cfg.PROXY for key in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY')}
+                          if cfg.PROXY else {}), **(extra_env or {})}
+            prefix = "".join(f"export {k}={shlex.quote(v)}; " for k, v in exports.items())
+            args, shell = ["su", "-", user, "-c", prefix + cmd], False
+        else:
+            args, shell = cmd, True
+        
+        if capture:
+            with _spawn(args, group=True, shell=shell, text=True, env=env,
+                        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
+                stdout, _ = proc.communicate(input)
+            if check and proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout)
+            return subprocess.CompletedProcess(args, proc.returncode, stdout=stdout, stderr=None)
+        
+        if stream:
+            return _run_streaming(args, shell, check, env, input)
+        
+        # 子进程直接写终端，先输出已排队的日志以保持顺序
+        logger.flush_console()
+        with _spawn(args, shell=shell, text=True, env=env,
+                    stdin=subprocess.PIPE if input is not None else None) as proc:
+            proc.communicate(input)
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        return subprocess.CompletedProcess(args, proc.returncode)
+
+
+def _run_streaming(args, shell: bool, check: bool, env: Dict[str, str], input: str = None,
+                   tail_lines: int = 500) -> subprocess.CompletedProcess:
+    """逐行读取子进程输出并转发到日志，内存中只保留最后 tail_lines 行"""
+    logger = get_logger()
+    tail = deque(maxlen=tail_lines)
     
-    # 执行命令
-    if user:
-        cmd = f"su - {user} -c '{cmd}'"
+    with _spawn(args, shell=shell, env=env, text=True, bufsize=1,
+                stdin=subprocess.PIPE if input is not None else None,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
+        if input is not None:
+            # 输入很短（密码等），远小于管道缓冲区，写入不会阻塞
+            proc.stdin.write(input)
+            proc.stdin.close()
+        for line in proc.stdout:
+            logger.log(line.rstrip('\n'), 'INFO', 'N')
+            tail.append(line)
     
-    return subprocess.run(cmd, shell=True, check=check, capture_output=True, text=True, env=env)
+    output = "".join(tail)
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, output=output)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout=output, stderr="")
+
+def _read_all(path: Union[str, Path]) -> str:
+    """一次性读取小型配置文件（fstat 取大小后单次 read，省去缓冲 IO 对象）"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, os.fstat(fd).st_size).decode('utf-8')
+    finally:
+        os.close(fd)
 
+def _write_atomic(path: Union[str, Path], content: str):
+    """原子写入配置文件：写同目录临时文件后 os.replace，保留原文件的属主与权限
+    
+    新建文件时权限为 0644（与普通配置文件一致）。
+    path 为符号链接（如 dotfile 管理的 ~/.zshrc）时替换其指向的真实文件，链接本身保持不变。
+    """
+    path = Path(os.path.realpath(path))
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        st = None
+    
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.write(fd, content.encode('utf-8'))
+            if st:
+                os.fchown(fd, st.st_uid, st.st_gid)
+                os.fchmod(fd, st.st_mode & 0o7777)
+            else:
+                os.fchmod(fd, 0o644)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+@lru_cache(maxsize=None)
 def exists(cmd: str) -> bool:
-    """检查命令是否存在"""
-    return subprocess.run(f"command -v {cmd}", shell=True, 
-                         capture_output=True).returncode == 0
+    """检查命令是否存在（按进程缓存，安装新软件后需调用 cache_clear）"""
+    return shutil.which(cmd) is not None
 
+@lru_cache(maxsize=None)
 def user_exists(name: str) -> bool:
-    """检查用户是否存在"""
-    return subprocess.run(f"id {name}", shell=True, 
-                         capture_output=True).returncode == 0
+    """检查用户是否存在（按进程缓存，创建用户后需调用 cache_clear）"""
+    try:
+        pwd.getpwnam(name)
+        return True
+    except KeyError:
+        return False
 
-def log(msg: str, c: str = 'N'):
-    """彩色日志 - 使用新的双输出系统"""
-    logger = get_logger()
-    level = {'R': 'ERROR', 'Y': 'WARNING', 'G': 'INFO', 'B': 'INFO', 'C': 'INFO', 'N': 'INFO'}.get(c, 'INFO')
-    logger.log(msg, level, c)
+@lru_cache(maxsize=None)
+def cached_pkg_set() -> frozenset:
+    """已安装的 pacman 包名集合（只扫描一次本地数据库，安装新包后需调用 cache_clear）"""
+    try:
+        # 目录名格式: <包名>-<版本>-<发布号>
+        return frozenset(entry.name.rsplit('-', 2)[0]
+                         for entry in os.scandir(PACMAN_LOCAL_DB) if entry.is_dir())
+    except OSError:
+        return frozenset()
+
+def pkg_installed(name: str) -> bool:
+    """检查 pacman 包是否已安装"""
+    return name in cached_pkg_set()
+
+def log(msg: str, c: str = 'N', *args):
+    """彩色日志 - 使用新的双输出系统
+    
+    循环中的日志可写成 log("  %d. %s", 'C', i, name)，由日志系统统一格式化。
+    """
+    logger = log.logger
+    if logger is None:
+        logger = log.logger = get_logger()
+    logger.log(msg, _COLOR_LEVELS.get(c, 'INFO'), c, *args)
+
+log.logger = None  # 首次调用后缓存日志实例
+
+def ask(prompt: str, secret: bool = False) -> str:
+    """读取用户输入（先排空控制台输出队列，保证提示出现在已输出的日志之后）"""
+    get_logger().flush_console()
+    return getpass.getpass(prompt) if secret else input(prompt)
 
 def section(title: str):
     """打印章节"""
@@ -462,6 +1047,7 @@ class Feature(ABC):
     
     def run_with_tracking(self):
         """执行功能并跟踪结果"""
+        check_cancelled()
         tracker = get_task_tracker()
         self._start_time = time.time()
         
@@ -490,15 +1076,41 @@ class Feature(ABC):
         """功能名称"""
         pass
     
-    @property
-    def needs_user(self) -> bool:
-        """是否需要用户信息"""
-        return False
+    # 是否需要用户信息（类属性，无需实例化即可读取）
+    needs_user: bool = False
     
     @property
     def order(self) -> int:
         """执行顺序（越小越先执行）"""
         return 50
+    
+    # 前置依赖（功能 key 元组）：依赖满足后即可与其他功能并发执行
+    # 未选中的依赖会向上传递；None 表示等待所有 order 更小的已选功能（串行）
+    # 注意：修改同一文件（如 ~/.zshrc）的功能必须处于同一条依赖链上，不能并发
+    depends: Optional[tuple] = None
+    
+    # 交互式功能（需要用户在终端操作）独占执行：不与任何其他功能并发
+    interactive: bool = False
+    
+    # 失败处理策略：abort 停止后续安装；skip 记录后继续；prompt 询问是否继续
+    on_failure: str = "skip"
+    
+    # 需安装的 pacman 包对应的配置项；所有已选功能的包合并为一次 pacman 事务安装
+    pkg_key: Optional[str] = None
+    
+    def install_pkgs(self) -> List[str]:
+        """安装本功能所需的包（经由合并事务），返回其中安装失败的包"""
+        cfg = get_config()
+        own = getattr(cfg, self.pkg_key)
+        installer = self.ctx.pacman_install or AggregatedPacmanInstall(own)
+        failed = set(installer.install())
+        return [pkg for pkg in own if pkg in failed]
+    
+    def missing_pkgs(self) -> List[str]:
+        """本功能需要在本次运行安装的包（含已由合并事务先行装好的包）"""
+        own = getattr(get_config(), self.pkg_key)
+        installer = self.ctx.pacman_install
+        return installer.missing(own) if installer else [pkg for pkg in own if not pkg_installed(pkg)]
 
 
 # ==========================================
@@ -507,6 +1119,7 @@ class Feature(ABC):
 class Registry:
     """功能注册中心"""
     _features: Dict[str, type] = {}
+    _sorted_cache: Optional[List[tuple]] = None
     
     @classmethod
     def register(cls, key: str, order: int = 50):
@@ -515,6 +1128,7 @@ class Registry:
             feature_class._key = key
             feature_class._order = order
             cls._features[key] = feature_class
+            cls._sorted_cache = None
             return feature_class
         return wrapper
     
@@ -525,6 +1139,13 @@ class Registry:
     @classmethod
     def all(cls) -> Dict[str, type]:
         return cls._features
+    
+    @classmethod
+    def sorted(cls) -> List[tuple]:
+        """按 order 排序的 (key, 功能类) 列表（缓存，注册新功能时失效）"""
+        if cls._sorted_cache is None:
+            cls._sorted_cache = sorted(cls._features.items(), key=lambda x: x[1]._order)
+        return cls._sorted_cache
 
 
 # ==========================================
@@ -533,6 +1154,29 @@ class Registry:
 @Registry.register('mirrors', order=5)
 class ConfigureMirrors(Feature):
     name = "配置镜像源"
+    depends = ()
+    
+    def _rank_mirrors(self, mirrors: List[str]) -> List[tuple]:
+        """并发探测各镜像的 core.db（HEAD 请求），返回按延迟升序排列的 (镜像, 延迟) 列表"""
+        import urllib.request
+        from concurrent.futures import ThreadPoolExecutor
+        
+        opener = url_opener()
+        
+        def probe(mirror: str) -> float:
+            url = mirror.replace('$repo', 'core').replace('$arch', 'x86_64').rstrip('/') + '/core.db'
+            start = time.monotonic()
+            try:
+                with opener.open(urllib.request.Request(url, method='HEAD'), timeout=3):
+                    return time.monotonic() - start
+            except Exception:
+                return float('inf')
+        
+        with ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+            latencies = list(executor.map(probe, mirrors))
+        
+        # 排序稳定：探测失败的镜像保持配置顺序排在最后
+        return sorted(zip(mirrors, latencies), key=lambda x: x[1])
     
     def execute(self):
         section(self.name)
@@ -547,33 +1191,120 @@ class ConfigureMirrors(Feature):
         # 备份原始 mirrorlist
         backup_path = Path("/etc/pacman.d/mirrorlist.backup")
         if not backup_path.exists() and mirrorlist_path.exists():
-            import shutil
             shutil.copy(mirrorlist_path, backup_path)
             log("✓ 已备份原始 mirrorlist", 'G')
         
-        # 生成新的 mirrorlist
-        log("正在配置中国镜像源...", 'C')
-        mirrors_content = "##\n## Arch Linux 中国镜像源\n"
-        mirrors_content += "## 由 arch_wsl_setup.py 自动生成\n##\n\n"
+        # 测速排序：最快的镜像写在最前面
+        log("正在测试镜像源速度...", 'C')
+        ranked = self._rank_mirrors(cfg.CHINA_MIRRORS) if cfg.CHINA_MIRRORS else []
+        mirrors = [mirror for mirror, _ in ranked]
+        # 显示名只取主机名（去掉端口与可能携带的认证信息），每个镜像只解析一次
+        from urllib.parse import urlsplit
+        names = [urlsplit(mirror).hostname or mirror for mirror in mirrors]
         
-        for i, mirror in enumerate(cfg.CHINA_MIRRORS, 1):
-            mirrors_content += f"## {i}. {mirror.split('/')[2]}\n"
-            mirrors_content += f"Server = {mirror}\n\n"
+        # 生成新的 mirrorlist（列表拼接，一次 join）
+        log("正在配置中国镜像源...", 'C')
+        parts = ["##\n## Arch Linux 中国镜像源\n## 由 arch_wsl_setup.py 自动生成\n##\n"]
+        for i, (mirror, mirror_name) in enumerate(zip(mirrors, names), 1):
+            parts.append(f"## {i}. {mirror_name}\nServer = {mirror}\n")
         
         # 写入 mirrorlist
-        mirrorlist_path.write_text(mirrors_content)
+        mirrorlist_path.write_text("\n".join(parts))
         
-        log(f"✓ 已配置 {len(cfg.CHINA_MIRRORS)} 个中国镜像源", 'G')
-        for i, mirror in enumerate(cfg.CHINA_MIRRORS, 1):
-            mirror_name = mirror.split('/')[2]
-            log(f"  {i}. {mirror_name}", 'C')
+        log(f"✓ 已配置 {len(mirrors)} 个中国镜像源（按延迟排序）", 'G')
+        for i, (mirror_name, (_, latency)) in enumerate(zip(names, ranked), 1):
+            latency_str = f"{latency * 1000:.0f} ms" if latency != float('inf') else "超时"
+            log("  %d. %s (%s)", 'C', i, mirror_name, latency_str)
         
         log("\n提示: 原始 mirrorlist 已备份到 /etc/pacman.d/mirrorlist.backup", 'Y')
 
 
+@Registry.register('pacman-conf', order=8)
+class ConfigurePacman(Feature):
+    name = "优化 pacman 配置"
+    depends = ()
+    
+    ARIA2C = "/usr/bin/aria2c"
+    XFER_COMMAND = (f"XferCommand = {ARIA2C} --allow-overwrite=true --continue=true --max-tries=3 "
+                    "--max-connection-per-server=16 --split=16 --min-split-size=1M "
+                    "--dir=/ -o %o %u")
+    _PARALLEL_RE = re.compile(r'^[ \t]*#?[ \t]*ParallelDownloads[ \t]*=.*$', re.MULTILINE)
+    
+    def execute(self):
+        section(self.name)
+        cfg = get_config()
+        conf_path = Path(PACMAN_CONF)
+        if not conf_path.exists():
+            log(f"未找到 {PACMAN_CONF}，跳过", 'Y')
+            return "skipped"
+        
+        content = _read_all(conf_path)
+        # 只匹配行内空白，避免 \s 跨行吞掉前面的空行
+        new_content, found = self._PARALLEL_RE.subn('ParallelDownloads = 10', content, count=1)
+        if not found:
+            new_content = content.replace('[options]', '[options]\nParallelDownloads = 10', 1)
+        
+        # 可选：用 aria2c 单文件多连接下载（设置 XferCommand 后 pacman 不再并行下载多个文件，
+        # 仅适合单连接限速的镜像）；aria2 未安装时本次不启用
+        use_aria2 = cfg.PACMAN_USE_ARIA2 and 'aria2c' not in new_content
+        if use_aria2 and not os.path.exists(self.ARIA2C):
+            log("  aria2 未安装（可加入 PKG_BASE），下次运行时再启用 aria2c 下载", 'Y')
+            use_aria2 = False
+        if use_aria2:
+            new_content = new_content.replace('[options]', f'[options]\n{self.XFER_COMMAND}', 1)
+        
+        if new_content == content:
+            log("pacman 配置已是最新，跳过", 'Y')
+            return "skipped"
+        
+        # 备份原始 pacman.conf（仅首次）
+        backup_path = Path(PACMAN_CONF + ".bak")
+        if not backup_path.exists():
+            shutil.copy(conf_path, backup_path)
+            log(f"✓ 已备份原始配置到 {backup_path}", 'G')
+        
+        _write_atomic(conf_path, new_content)
+        log("✓ 已启用 pacman 并行下载 (ParallelDownloads = 10)", 'G')
+        if use_aria2:
+            log("✓ 已启用 aria2c 多连接下载 (XferCommand)", 'G')
+
+
+@Registry.register('prefetch', order=9)
+class PrefetchPackages(Feature):
+    name = "预下载软件包"
+    depends = ('mirrors', 'pacman-conf')
+    
+    def execute(self):
+        section(self.name)
+        cfg = get_config()
+        
+        # 系统更新与各功能待装的包合并为一次仅下载事务，由 ParallelDownloads 统一并行拉取；
+        # 之后的 -Syu 与 -S 直接从 /var/cache/pacman/pkg 读取。
+        # 未选系统更新时只下载、不刷新数据库，避免刷新后直接 -S 造成部分升级
+        with_update = 'update' in self.ctx.selected
+        installer = self.ctx.pacman_install
+        pkgs = installer.pkgs if installer else cfg.pkgs_for(('base', 'optional'))
+        
+        if not check_network_connectivity():
+            log("✗ 网络连接失败，跳过预下载", 'Y')
+            return "skipped"
+        
+        log(f"正在预下载{'系统更新及 ' if with_update else ' '}{len(pkgs)} 个软件包...", 'G')
+        result = run(["pacman", "-Syuw" if with_update else "-Sw", "--needed", "--noconfirm", *pkgs],
+                     check=False, stream=True)
+        self.ctx.db_synced = with_update and result.returncode == 0
+        if result.returncode != 0:
+            # 预下载失败不影响后续流程，安装阶段会重新下载
+            log("⚠ 部分软件包预下载失败，将在安装时重试", 'Y')
+        else:
+            log("✓ 完成", 'G')
+
+
 @Registry.register('update', order=10)
 class UpdateSystem(Feature):
     name = "系统更新"
+    depends = ('mirrors', 'pacman-conf', 'prefetch')
+    on_failure = "abort"
     
     def execute(self):
         section(self.name)
@@ -587,21 +1318,27 @@ class UpdateSystem(Feature):
         if not check_network_connectivity():
             log("✗ 网络连接失败，无法更新系统", 'R')
             cfg = get_config()
-            log(f"  提示: 尝试连接 {cfg.NETWORK_CHECK_HOST}:{cfg.NETWORK_CHECK_PORT} 失败", 'Y')
+            hosts = ', '.join(cfg.NETWORK_CHECK_HOSTS or [cfg.NETWORK_CHECK_HOST])
+            log(f"  提示: 尝试连接 {hosts} (端口 {cfg.NETWORK_CHECK_PORT}) 失败", 'Y')
             raise Exception("网络不可用")
         
         log("正在更新系统...", 'G')
         try:
-            run("pacman -Syyu --noconfirm")
+            # 预下载已刷新同步数据库时无需 -yy 强制重新下载
+            run(f"pacman -{'Syu' if self.ctx.db_synced else 'Syyu'} --noconfirm", stream=True)
             log("✓ 完成", 'G')
         except subprocess.CalledProcessError as e:
             log(f"⚠ 系统更新遇到问题，但将继续: {e}", 'Y')
             # 尝试刷新密钥环
             try:
                 log("尝试刷新 pacman 密钥...", 'C')
-                run("pacman-key --init")
-                run("pacman-key --populate archlinux")
-                run("pacman -Syyu --noconfirm")
+                # 已有密钥环时跳过 --init（生成主密钥需收集熵，WSL 中可能耗时数十秒）
+                if not Path(PACMAN_GNUPG, "pubring.gpg").exists():
+                    log("  正在初始化密钥环，若长时间无响应可安装 haveged 或 rng-tools 补充熵", 'C')
+                    run(["pacman-key", "--init", f"--gpgdir={PACMAN_GNUPG}"])
+                run(["pacman-key", "--populate", "archlinux", f"--gpgdir={PACMAN_GNUPG}"])
+                # 同步数据库已在第一次尝试中下载，无需再次强制刷新
+                run("pacman -Su --noconfirm", stream=True)
                 log("✓ 完成", 'G')
             except Exception as e2:
                 log(f"✗ 无法完成系统更新: {e2}", 'R')
@@ -611,59 +1348,60 @@ class UpdateSystem(Feature):
 @Registry.register('base', order=11)
 class InstallBase(Feature):
     name = "安装基础包"
+    depends = ('update',)
+    pkg_key = 'PKG_BASE'
+    on_failure = "abort"
     
     def execute(self):
         section(self.name)
-        cfg = get_config()
-        log(f"正在安装 {len(cfg.PKG_BASE)} 个包...", 'G')
-        try:
-            run(f"pacman -S --noconfirm {' '.join(cfg.PKG_BASE)}")
+        
+        # 只安装尚未安装的包（读取本地 pacman 数据库，无需调用 pacman -Q）；
+        # 已由合并事务在本次运行中装好的包仍计为本功能的安装结果
+        if not self.missing_pkgs():
+            log("所有包均已安装，跳过", 'Y')
+            return "skipped"
+        
+        failed = self.install_pkgs()
+        for pkg in failed:
+            log(f"  ✗ {pkg}", 'R')
+        if failed:
+            log(f"⚠ 以下包安装失败: {', '.join(failed)}", 'Y')
+        else:
             log("✓ 完成", 'G')
-        except subprocess.CalledProcessError as e:
-            log("⚠ 批量安装失败，尝试逐个安装...", 'Y')
-            failed = []
-            for pkg in cfg.PKG_BASE:
-                try:
-                    run(f"pacman -S --noconfirm {pkg}")
-                    log(f"  ✓ {pkg}", 'G')
-                except Exception:
-                    log(f"  ✗ {pkg}", 'R')
-                    failed.append(pkg)
-            if failed:
-                log(f"⚠ 以下包安装失败: {', '.join(failed)}", 'Y')
-            else:
-                log("✓ 全部完成", 'G')
 
 
 @Registry.register('optional', order=12)
 class InstallOptional(Feature):
     name = "安装可选包"
+    depends = ('base',)
+    pkg_key = 'PKG_OPT'
     
     def execute(self):
         section(self.name)
-        cfg = get_config()
-        log(f"正在安装 {len(cfg.PKG_OPT)} 个可选包...", 'G')
-        try:
-            run(f"pacman -S --noconfirm {' '.join(cfg.PKG_OPT)}")
+        
+        # 只安装尚未安装的包（读取本地 pacman 数据库，无需调用 pacman -Q）；
+        # 已由合并事务在本次运行中装好的包仍计为本功能的安装结果
+        if not self.missing_pkgs():
+            log("所有包均已安装，跳过", 'Y')
+            return "skipped"
+        
+        failed = self.install_pkgs()
+        for pkg in failed:
+            log(f"  ✗ {pkg}", 'R')
+        if failed:
+            log(f"⚠ 以下可选包安装失败（不影响主要功能）: {', '.join(failed)}", 'Y')
+        else:
             log("✓ 完成", 'G')
-        except subprocess.CalledProcessError as e:
-            log("⚠ 批量安装失败，尝试逐个安装...", 'Y')
-            failed = []
-            for pkg in cfg.PKG_OPT:
-                try:
-                    run(f"pacman -S --noconfirm {pkg}")
-                    log(f"  ✓ {pkg}", 'G')
-                except Exception:
-                    log(f"  ✗ {pkg}", 'R')
-                    failed.append(pkg)
-            if failed:
-                log(f"⚠ 以下可选包安装失败（不影响主要功能）: {', '.join(failed)}", 'Y')
 
 
 @Registry.register('user', order=20)
 class CreateUser(Feature):
     name = "创建用户"
     needs_user = True
+    depends = ('base',)
+    on_failure = "abort"
+    
+    _WHEEL_RE = re.compile(r'^#\s*%wheel ALL=\(ALL:ALL\) ALL', re.MULTILINE)
     
     def execute(self):
         section(f"{self.name}: {self.ctx.username}")
@@ -672,19 +1410,22 @@ class CreateUser(Feature):
             return "skipped"
         
         cfg = get_config()
-        run(f"useradd -m -G wheel -s {self.ctx.shell} {self.ctx.username}")
-        run(f"echo '{self.ctx.username}:{self.ctx.password}' | chpasswd")
+        run(["useradd", "-m", "-G", "wheel", "-s", self.ctx.shell, self.ctx.username])
+        user_exists.cache_clear()
+        # 数据收集时用户尚不存在，home 目录为空，创建后补上供后续功能使用
+        self.ctx.user_home = self.ctx._get_home()
+        run(["chpasswd"], input=f"{self.ctx.username}:{self.ctx.password}\n")
         
-        # 配置 sudo (使用 pathlib)
+        # 配置 sudo：一次 subn 取消注释，未找到时再追加
         sudoers_path = Path(cfg.SUDOERS)
-        content = sudoers_path.read_text()
+        content = _read_all(sudoers_path)
         
-        if "# %wheel ALL=(ALL:ALL) ALL" in content:
-            content = content.replace("# %wheel ALL=(ALL:ALL) ALL", "%wheel ALL=(ALL:ALL) ALL")
-        elif "%wheel ALL=(ALL:ALL) ALL" not in content:
-            content += "\n%wheel ALL=(ALL:ALL) ALL\n"
+        new_content, count = self._WHEEL_RE.subn("%wheel ALL=(ALL:ALL) ALL", content, count=1)
+        if not count and "%wheel ALL=(ALL:ALL) ALL" not in new_content:
+            new_content += "\n%wheel ALL=(ALL:ALL) ALL\n"
         
-        sudoers_path.write_text(content)
+        if new_content != content:
+            _write_atomic(sudoers_path, new_content)
         log("✓ 完成", 'G')
 
 
@@ -692,15 +1433,16 @@ class CreateUser(Feature):
 class ConfigureWSL(Feature):
     name = "配置 WSL"
     needs_user = True
+    # 默认登录用户须在账户创建成功后再写入
+    depends = ('user',)
     
     def execute(self):
         section(self.name)
         cfg = get_config()
         config = f"[user]\ndefault={self.ctx.username}\n\n[boot]\nsystemd={str(self.ctx.enable_systemd).lower()}\n"
         
-        # 使用 pathlib
-        wsl_conf_path = Path(cfg.WSL_CONF)
-        wsl_conf_path.write_text(config)
+        # os.open + 单次 os.write 写入（不经 TextIOWrapper），临时文件替换保证不会半写
+        _write_atomic(cfg.WSL_CONF, config)
         
         log(f"✓ 默认用户: {self.ctx.username}, Systemd: {self.ctx.enable_systemd}", 'G')
 
@@ -709,6 +1451,7 @@ class ConfigureWSL(Feature):
 class InstallOhMyZsh(Feature):
     name = "安装 Oh My Zsh"
     needs_user = True
+    depends = ('user', 'base')
     
     def execute(self):
         section(self.name)
@@ -726,9 +1469,22 @@ class InstallOhMyZsh(Feature):
             log("✗ 网络连接失败", 'R')
             raise Exception("网络不可用")
         
+        cleanup_mgr = get_cleanup_manager()
+        cleanup_mgr.register(str(omz_path), "dir", self.ctx.username, "Oh My Zsh 目录（半成品）")
+        
+        # 直接浅克隆仓库（等同官方安装脚本 --unattended 的效果，省去 curl + sh 且不拉取历史）
+        zshrc_path = Path(self.ctx.user_home) / ".zshrc"
         try:
-            # 网络操作已自动带重试机制（run 函数的装饰器）
-            run(f'sh -c "$(curl -fsSL {cfg.OMZ_URL})" "" --unattended', user=self.ctx.username)
+            run(["git", "clone", "--depth=1", "--single-branch", "--no-tags", cfg.OMZ_REPO, str(omz_path)],
+                user=self.ctx.username)
+            cleanup_mgr.unregister(str(omz_path))
+            
+            # 与官方脚本一致：已有的非 Oh My Zsh 配置备份为 .zshrc.pre-oh-my-zsh，再使用模板
+            if zshrc_path.exists() and "oh-my-zsh" not in _read_all(zshrc_path):
+                run(["mv", str(zshrc_path), f"{zshrc_path}.pre-oh-my-zsh"], user=self.ctx.username)
+            if not zshrc_path.exists():
+                run(["cp", str(omz_path / "templates" / "zshrc.zsh-template"), str(zshrc_path)],
+                    user=self.ctx.username)
             log("✓ 完成", 'G')
         except Exception as e:
             log(f"✗ 安装失败: {e}", 'R')
@@ -740,6 +1496,7 @@ class InstallOhMyZsh(Feature):
 class InstallZshPlugins(Feature):
     name = "安装 Zsh 插件"
     needs_user = True
+    depends = ('omz',)
     
     def _install_plugin(self, name: str, url: str, custom_path: Path) -> tuple:
         """安装单个插件（线程安全）"""
@@ -754,13 +1511,11 @@ class InstallZshPlugins(Feature):
             cleanup_mgr = get_cleanup_manager()
             cleanup_mgr.register(str(plugin_path), "dir", self.ctx.username, f"插件 {name}")
             
-            run(f"git clone {url} {plugin_path}", user=self.ctx.username)
+            run(["git", "clone", "--depth=1", "--single-branch", "--no-tags", url, str(plugin_path)],
+                user=self.ctx.username)
             
             # 安装成功，从清理列表移除
-            cleanup_mgr._cleanup_items = [
-                item for item in cleanup_mgr._cleanup_items 
-                if item['path'] != str(plugin_path)
-            ]
+            cleanup_mgr.unregister(str(plugin_path))
             
             return (name, 'success', f"✓ {name}")
         except Exception as e:
@@ -773,24 +1528,28 @@ class InstallZshPlugins(Feature):
         # 使用 pathlib
         custom_path = Path(self.ctx.user_home) / ".oh-my-zsh" / "custom" / "plugins"
         
-        log(f"并发安装 {len(cfg.ZSH_PLUGINS)} 个插件...", 'C')
+        plugins = cfg.ZSH_PLUGINS or {}
+        if not plugins:
+            log("未配置插件，跳过", 'Y')
+            return "skipped"
+        
+        log(f"并发安装 {len(plugins)} 个插件...", 'C')
         
         # 检查网络
         if not check_network_connectivity():
             log("✗ 网络连接失败", 'R')
             raise Exception("网络不可用")
         
-        # 并发执行
-        with ThreadPoolExecutor(max_workers=len(cfg.ZSH_PLUGINS)) as executor:
-            futures = {
-                executor.submit(self._install_plugin, name, url, custom_path): name
-                for name, url in cfg.ZSH_PLUGINS.items()
-            }
-            
-            for future in as_completed(futures):
-                name, status, msg = future.result()
-                color = {'skip': 'Y', 'success': 'G', 'error': 'R'}[status]
-                log(msg, color)
+        # 并发克隆（瓶颈在远端延迟，线程数封顶 8）；全部结束后按配置顺序输出结果
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(8, len(plugins))) as executor:
+            results = list(executor.map(
+                lambda item: self._install_plugin(item[0], item[1], custom_path), plugins.items()
+            ))
+        
+        colors = {'skip': 'Y', 'success': 'G', 'error': 'R'}
+        for name, status, msg in results:
+            log(msg, colors[status])
         
         log("✓ 插件安装完成", 'G')
 
@@ -799,12 +1558,19 @@ class InstallZshPlugins(Feature):
 class ConfigureZshrc(Feature):
     name = "配置 .zshrc"
     needs_user = True
+    depends = ('zsh-plugins',)
+    
+    # 预编译正则
+    _PLUGIN_RE = re.compile(r'^plugins=\([^)]*\)', re.MULTILINE)
+    _EDITOR_RE = re.compile(r'^export EDITOR=.*', re.MULTILINE)
+    _FASTFETCH_RE = re.compile(r'^fastfetch\s*$', re.MULTILINE)
     
-    def _ensure_line(self, content: str, pattern: str, line: str) -> str:
+    def _ensure_line(self, content: str, pattern: re.Pattern, line: str) -> str:
         """幂等性添加/替换行（类似 Ansible lineinfile）"""
-        if re.search(pattern, content, re.MULTILINE):
+        new_content, count = pattern.subn(line, content)
+        if count:
             # 已存在，替换
-            content = re.sub(pattern, line, content, flags=re.MULTILINE)
+            content = new_content
             log(f"  已更新: {line[:50]}...", 'Y')
         else:
             # 不存在，添加
@@ -822,26 +1588,24 @@ class ConfigureZshrc(Feature):
             log(".zshrc 不存在，跳过", 'Y')
             return "skipped"
         
-        content = zshrc_path.read_text()
+        content = _read_all(zshrc_path)
         
-        # 配置插件（使用正则匹配）
-        plugin_pattern = r'^plugins=\([^)]*\)'
+        # 配置插件（使用正则匹配，一次 subn 同时完成检测与替换）
         desired_plugins = 'plugins=(git z zsh-autosuggestions zsh-syntax-highlighting)'
-        if re.search(plugin_pattern, content, re.MULTILINE):
-            old_match = re.search(plugin_pattern, content, re.MULTILINE)
-            if old_match and old_match.group(0) != desired_plugins:
-                content = re.sub(plugin_pattern, desired_plugins, content, flags=re.MULTILINE)
-                log(f"  插件已更新", 'G')
-            else:
-                log(f"  插件配置已是最新", 'Y')
-        else:
+        new_content, count = self._PLUGIN_RE.subn(desired_plugins, content)
+        if not count:
             log("  未找到 plugins 配置", 'Y')
+        elif new_content != content:
+            content = new_content
+            log(f"  插件已更新", 'G')
+        else:
+            log(f"  插件配置已是最新", 'Y')
         
         # 幂等性添加配置项
-        content = self._ensure_line(content, r'^export EDITOR=.*', 'export EDITOR=nano')
-        content = self._ensure_line(content, r'^fastfetch\s*$', '# System info\nfastfetch')
+        content = self._ensure_line(content, self._EDITOR_RE, 'export EDITOR=nano')
+        content = self._ensure_line(content, self._FASTFETCH_RE, '# System info\nfastfetch')
         
-        zshrc_path.write_text(content)
+        _write_atomic(zshrc_path, content)
         log("✓ 完成", 'G')
 
 
@@ -849,6 +1613,7 @@ class ConfigureZshrc(Feature):
 class InstallYay(Feature):
     name = "安装 Yay"
     needs_user = True
+    depends = ('user', 'base')
     
     def execute(self):
         section(self.name)
@@ -870,26 +1635,29 @@ class InstallYay(Feature):
             log("✗ 网络连接失败", 'R')
             raise Exception("网络不可用")
         
+        # 克隆目录名取自仓库地址（yay-bin 为预编译包，yay 为源码包）
+        repo_dir = cfg.YAY_REPO.rstrip('/').rsplit('/', 1)[-1].removesuffix('.git')
+        
         try:
             script = f"""
 cd {self.ctx.user_home}
 rm -rf tmp_yay
 mkdir tmp_yay && cd tmp_yay
-git clone {cfg.YAY_REPO}
-cd yay
-echo '{self.ctx.password}' | sudo -S -v
+git clone --depth=1 {cfg.YAY_REPO}
+cd {repo_dir}
+sudo -S -v
 makepkg -si --noconfirm
 cd {self.ctx.user_home}
 rm -rf tmp_yay
 """
-            run(script, user=self.ctx.username, mask_log=True)
+            # 密码经 stdin 交给脚本中的 sudo -S，不嵌入脚本文本
+            run(script, user=self.ctx.username, stream=True, input=f"{self.ctx.password}\n")
+            exists.cache_clear()
+            cached_pkg_set.cache_clear()
             log("✓ 完成", 'G')
             
             # 成功后从清理列表移除（脚本已自行清理）
-            cleanup_mgr._cleanup_items = [
-                item for item in cleanup_mgr._cleanup_items 
-                if item['path'] != str(build_dir)
-            ]
+            cleanup_mgr.unregister(str(build_dir))
         except Exception as e:
             log(f"✗ 安装失败: {e}", 'R')
             log("提示: 请检查网络连接或 base-devel 是否已安装", 'Y')
@@ -901,6 +1669,8 @@ rm -rf tmp_yay
 class InstallConda(Feature):
     name = "安装 Miniconda"
     needs_user = True
+    # conda init 会修改 ~/.zshrc，须排在 omz → zsh-plugins → zshrc 这条链之后
+    depends = ('zshrc',)
     
     def execute(self):
         section(self.name)
@@ -926,21 +1696,20 @@ class InstallConda(Feature):
             raise Exception("网络不可用")
         
         try:
+            sha256 = download(cfg.CONDA_URL, installer, user=self.ctx.username)
+            log(f"✓ 安装脚本已下载 (sha256: {sha256[:16]}...)", 'G')
+            
             script = f"""
-wget -q {cfg.CONDA_URL} -O ~/miniconda.sh
-bash ~/miniconda.sh -b -p {conda_dir}
-rm ~/miniconda.sh
+bash {installer} -b -p {conda_dir}
+rm -f {installer}
 {conda_dir}/bin/conda init zsh
 {conda_dir}/bin/conda config --set auto_activate_base false
 """
-            run(script, user=self.ctx.username)
+            run(script, user=self.ctx.username, stream=True)
             log("✓ 完成", 'G')
             
             # 成功后从清理列表移除
-            cleanup_mgr._cleanup_items = [
-                item for item in cleanup_mgr._cleanup_items 
-                if item['path'] not in [str(installer), str(conda_dir)]
-            ]
+            cleanup_mgr.unregister(str(installer), str(conda_dir))
         except Exception as e:
             log(f"✗ 安装失败: {e}", 'R')
             log("提示: 请检查网络连接或磁盘空间", 'Y')
@@ -952,28 +1721,40 @@ rm ~/miniconda.sh
 class ConfigureGitHub(Feature):
     name = "配置 GitHub"
     needs_user = True
+    depends = ('user',)
+    interactive = True
+    pkg_key = 'PKG_GH'
     
     def execute(self):
         section(self.name)
         cfg = get_config()
         
-        # 安装 gh
+        # 安装 gh（若已随其他功能合并安装则直接跳过）
         if not exists('gh'):
-            run(f"pacman -S --noconfirm {' '.join(cfg.PKG_GH)}")
+            failed = self.install_pkgs()
+            if failed:
+                raise Exception(f"安装失败: {', '.join(failed)}")
         
         # 配置
         log("请按照提示配置 GitHub (SSH + Web browser 认证)", 'C')
         log("提示：Protocol=SSH, Generate key=Yes, Auth=Web browser", 'Y')
         run("gh auth login", user=self.ctx.username, check=False)
         
-        # 同步 git 配置
+        # 同步 git 配置（查询与写入合并为一个脚本，末行输出 OK:<用户名>）
+        script = """
+name=$(gh api user -q .name)
+email=$(gh api user -q .email)
+[ -n "$name" ] && git config --global user.name "$name"
+[ -n "$email" ] && git config --global user.email "$email"
+echo "OK:$name"
+"""
         try:
-            name = run("gh api user -q .name", user=self.ctx.username).stdout.strip()
-            email = run("gh api user -q .email", user=self.ctx.username).stdout.strip()
+            output = run(script, user=self.ctx.username, capture=True).stdout
+            name = output.rstrip().rpartition("\n")[2].partition("OK:")[2]
             if name:
-                run(f"git config --global user.name '{name}'", user=self.ctx.username)
-                run(f"git config --global user.email '{email}'", user=self.ctx.username)
                 log(f"✓ Git 配置完成 (用户: {name})", 'G')
+            else:
+                log("无法自动配置 Git 用户信息", 'Y')
         except:
             log("无法自动配置 Git 用户信息", 'Y')
 
@@ -981,12 +1762,18 @@ class ConfigureGitHub(Feature):
 # ==========================================
 # 主控制器 - 流程编排
 # ==========================================
+# 菜单输入解析：全角逗号与空格都视为分隔符，每一项须完整匹配区间 (a-b) 或单个序号
+_SEL_TRANS = str.maketrans({'，': ',', ' ': ','})
+_SEL_RE = re.compile(r'(\d+)-(\d+)|(\d+)')
+
+
 class App:
     """应用主控制器"""
     
     def __init__(self):
         self.ctx = Context()
         self.selected = []
+        self.failures: List[tuple] = []  # (功能名称, 错误信息)
     
     def run(self):
         """主流程"""
@@ -1009,42 +1796,39 @@ class App:
     
     def _menu(self) -> List[str]:
         """显示菜单并获取选择"""
-        features = Registry.all()
-        sorted_features = sorted(features.items(), key=lambda x: x[1]._order)
+        sorted_features = Registry.sorted()
         
         log("请选择功能（多选用逗号分隔，A=全部）：\n" + "-"*60, 'B')
-        for i, (key, cls) in enumerate(sorted_features, 1):
-            # 实例化以访问 name 属性
-            temp = cls(Context())
-            print(f"  [{i}] {temp.name}")
+        # 整个菜单拼接后一次写出（name 是类属性，无需实例化）
+        get_logger().console("".join(f"  [{i}] {cls.name}\n" for i, (_, cls) in enumerate(sorted_features, 1)))
         log("  [A] 全部安装", 'B')
         log("-"*60 + "\n示例: 1,2,4  或  1-5  或  A", 'Y')
         
         while True:
-            choice = input("\n选择: ").strip().upper()
+            choice = ask("\n选择: ").strip().upper()
             if choice == 'A':
-                return list(features.keys())
+                return [key for key, _ in sorted_features]
             
-            try:
-                selected = []
-                for part in choice.replace('，', ',').split(','):
-                    part = part.strip()
-                    if '-' in part:
-                        start, end = map(int, part.split('-'))
-                        selected.extend([sorted_features[i-1][0] for i in range(start, end+1)])
-                    else:
-                        idx = int(part) - 1
-                        selected.append(sorted_features[idx][0])
+            selected = []
+            for token in filter(None, choice.translate(_SEL_TRANS).split(',')):
+                match = _SEL_RE.fullmatch(token)
+                if not match:
+                    break
+                start, end, single = match.groups()
+                indices = range(int(start), int(end) + 1) if start else range(int(single), int(single) + 1)
+                # 序号越界或区间为空时整体视为无效输入
+                if not indices or not (0 < indices[0] and indices[-1] <= len(sorted_features)):
+                    break
+                selected.extend(sorted_features[i-1][0] for i in indices)
+            else:
                 if selected:
                     return selected
-            except:
-                pass
             log("输入无效，请重试", 'R')
     
     def _collect_data(self):
         """收集用户数据"""
         # 检查是否需要用户信息
-        needs_user = any(Registry.get(key)(self.ctx).needs_user for key in self.selected)
+        needs_user = any(Registry.get(key).needs_user for key in self.selected)
         if not needs_user:
             return
         
@@ -1053,10 +1837,10 @@ class App:
         
         # 用户名
         while True:
-            username = input("\n用户名: ").strip()
+            username = ask("\n用户名: ").strip()
             if username:
                 if user_exists(username):
-                    if input(f"用户 {username} 已存在，继续使用? (y/n): ").lower() == 'y':
+                    if ask(f"用户 {username} 已存在，继续使用? (y/n): ").lower() == 'y':
                         self.ctx.username = username
                         self.ctx.user_home = self.ctx._get_home()
                         break
@@ -1067,8 +1851,8 @@ class App:
         # 密码（仅在创建用户或安装 yay 时需要）
         if 'user' in self.selected or 'yay' in self.selected:
             while True:
-                pwd = getpass.getpass("密码: ")
-                pwd2 = getpass.getpass("确认密码: ")
+                pwd = ask("密码: ", secret=True)
+                pwd2 = ask("确认密码: ", secret=True)
                 if pwd and pwd == pwd2:
                     self.ctx.password = pwd
                     break
@@ -1077,12 +1861,12 @@ class App:
         # Shell
         if 'user' in self.selected and not user_exists(self.ctx.username):
             log("\nShell: 1) bash  2) zsh (推荐)", 'B')
-            shell = input("选择 [默认 2]: ").strip() or "2"
+            shell = ask("选择 [默认 2]: ").strip() or "2"
             self.ctx.shell = "/bin/zsh" if shell == "2" else "/bin/bash"
         
         # Systemd
         if 'wsl' in self.selected:
-            systemd = input("\n启用 Systemd? (Y/n): ").lower() or 'y'
+            systemd = ask("\n启用 Systemd? (Y/n): ").lower() or 'y'
             self.ctx.enable_systemd = (systemd == 'y')
         
         # 更新 home 目录
@@ -1090,24 +1874,109 @@ class App:
             self.ctx.user_home = self.ctx._get_home()
         
         log("\n✓ 数据收集完成！", 'G')
-        input("按 Enter 开始安装...")
+        ask("按 Enter 开始安装...")
     
     def _execute(self):
-        """执行选中的功能"""
+        """执行选中的功能（按依赖关系调度，依赖已满足的功能并发执行）"""
         section("执行安装")
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        cfg = get_config()
         
-        # 按 order 排序执行
-        features = [(key, Registry.get(key)) for key in self.selected]
-        features.sort(key=lambda x: x[1]._order)
+        # 按 order 排序，同时就绪的功能按此顺序提交
+        selected = set(self.selected)
+        features = [(key, cls) for key, cls in Registry.sorted() if key in selected]
+        deps = self._resolve_depends(features)
         
-        for key, feature_class in features:
-            try:
-                feature = feature_class(self.ctx)
-                feature.run_with_tracking()  # 使用跟踪执行
-            except Exception as e:
-                log(f"✗ 执行失败: {e}", 'R')
-                if input("继续? (y/n): ").lower() != 'y':
-                    break
+        # 已选功能的 pacman 包合并为一次事务，由最先执行到安装步骤的功能触发
+        self.ctx.pacman_install = AggregatedPacmanInstall(cfg.pkgs_for(selected))
+        self.ctx.selected = frozenset(selected)
+        
+        pending = dict(features)
+        done = set()
+        failed = set()
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=cfg.PARALLEL_WORKERS)
+        try:
+            while pending or running:
+                # 依赖失败（或因此被跳过）的功能不再执行，按 order 顺序逐个传递
+                for key in list(pending):
+                    if deps[key] & failed:
+                        names = ", ".join(Registry.get(k).name for k, _ in features if k in deps[key] & failed)
+                        self._skip(pending.pop(key), f"依赖 {names} 失败")
+                        failed.add(key)
+                
+                exclusive = any(Registry.get(k).interactive for k in running.values())
+                for key in [k for k in pending if deps[k] <= done]:
+                    if exclusive:
+                        break
+                    # 交互式功能等待在途功能全部结束后再单独提交
+                    if pending[key].interactive and running:
+                        continue
+                    exclusive = pending[key].interactive
+                    running[executor.submit(pending.pop(key)(self.ctx).run_with_tracking)] = key
+                if not running:
+                    if not pending:
+                        break
+                    raise RuntimeError(f"功能依赖无法满足: {', '.join(pending)}")
+                
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                check_cancelled()
+                # 需要中止或询问时先等待在途功能结束，避免提示与并发输出交错
+                if any(f.exception() and Registry.get(running[f]).on_failure != "skip" for f in finished):
+                    finished, _ = wait(running)
+                
+                errors = []
+                for future in finished:
+                    key = running.pop(future)
+                    if future.exception():
+                        failed.add(key)
+                        errors.append((key, future.exception()))
+                    else:
+                        done.add(key)
+                
+                for key, e in errors:
+                    feature_class = Registry.get(key)
+                    self.failures.append((feature_class.name, str(e)))
+                    log(f"✗ {feature_class.name} 执行失败: {e}", 'R')
+                    if feature_class.on_failure == "abort":
+                        log("关键步骤失败，停止后续安装", 'R')
+                        self._skip_all(pending, f"{feature_class.name} 失败，安装已中止")
+                        return
+                    if feature_class.on_failure == "prompt" and ask("继续? (y/n): ").lower() != 'y':
+                        self._skip_all(pending, f"{feature_class.name} 失败，用户选择停止")
+                        return
+        finally:
+            # 中断时取消尚未开始的功能，并等待在途功能（其子进程已被终止）退出后再返回，
+            # 保证清理动作在所有工作线程停止之后执行
+            executor.shutdown(wait=True, cancel_futures=_CANCEL.is_set())
+    
+    def _skip(self, feature_class, reason: str):
+        """记录未执行的功能（结果摘要中显示为跳过）"""
+        log(f"⊘ 跳过 {feature_class.name}: {reason}", 'Y')
+        get_task_tracker().record(feature_class.name, TaskStatus.SKIPPED, reason, 0)
+    
+    def _skip_all(self, pending: Dict[str, Any], reason: str):
+        """中止时把尚未执行的功能全部记录为跳过"""
+        for feature_class in pending.values():
+            self._skip(feature_class, reason)
+        pending.clear()
+    
+    def _resolve_depends(self, features: List[tuple]) -> Dict[str, set]:
+        """计算每个已选功能的前置依赖集合（未选中的依赖向上传递到其自身的依赖）"""
+        selected = {key for key, _ in features}
+        
+        def resolve(cls) -> set:
+            if cls.depends is None:
+                return {key for key, other in features if other._order < cls._order}
+            result = set()
+            for dep in cls.depends:
+                if dep in selected:
+                    result.add(dep)
+                elif Registry.get(dep):
+                    result |= resolve(Registry.get(dep))
+            return result
+        
+        return {key: resolve(cls) for key, cls in features}
     
     def _done(self):
         """完成提示"""
@@ -1117,8 +1986,16 @@ class App:
         tracker = get_task_tracker()
         tracker.print_summary()
         
+        if self.failures:
+            section("失败项")
+            for name, error in self.failures:
+                log(f"  ✗ {name}: {error}", 'R')
+        
         section("安装完成")
-        log("🎉 所有功能已完成！\n", 'G')
+        if self.failures:
+            log(f"⚠ {len(self.failures)} 个功能执行失败，详见上方列表及日志\n", 'Y')
+        else:
+            log("🎉 所有功能已完成！\n", 'G')
         log("重要提示：", 'Y')
         log("  1. 在 PowerShell 中运行: wsl --shutdown", 'C')
         log("  2. 重新启动 WSL", 'C')
@@ -1134,12 +2011,13 @@ class App:
 # 信号处理与清理钩子
 # ==========================================
 def signal_handler(signum, frame):
-    """信号处理器：捕获中断信号并清理"""
-    log("\n\n⚠ 接收到中断信号 (Ctrl+C)", 'Y')
-    cleanup_mgr = get_cleanup_manager()
-    cleanup_mgr.cleanup()
-    log("程序已退出", 'Y')
-    sys.exit(130)  # 128 + SIGINT(2)
+    """信号处理器：停止调度并终止在途子进程，再以 KeyboardInterrupt 交由主流程退出
+    
+    清理动作不在这里执行：主线程等待工作线程全部停止后，由 atexit 钩子执行清理。
+    """
+    log(f"\n\n⚠ 接收到中断信号 ({signal.Signals(signum).name})", 'Y')
+    cancel_all()
+    raise KeyboardInterrupt
 
 def cleanup_on_exit():
     """退出时清理钩子"""
@@ -1171,7 +2049,6 @@ if __name__ == "__main__":
                 sys.exit(1)
             
             # 复制示例文件
-            import shutil
             shutil.copy(example_file, "setup.yaml")
             print("✓ 已生成配置文件: setup.yaml")
             print("\n提示:")
@@ -1181,12 +2058,13 @@ if __name__ == "__main__":
             sys.exit(0)
         
         App().run()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, InstallCancelled):
         log("\n用户取消操作", 'Y')
-        # cleanup 会由 atexit 自动调用
-        sys.exit(0)
+        # cleanup 会由 atexit 在工作线程停止后自动调用
+        sys.exit(130)  # 128 + SIGINT(2)
     except Exception as e:
         log(f"\n错误: {e}", 'R')
+        get_logger().flush_console()
         import traceback
         traceback.print_exc()
         # cleanup 会由 atexit 自动调用
@@ -40,6 +40,7 @@ else
 fi
 
 echo -e "${GREEN}>>> 步骤 3/4: 安装 PyYAML (配置文件支持)...${NC}"
+# 注: Arch 的 python-yaml 已链接 libyaml，主程序会自动使用 CSafeLoader，无需额外依赖
 if ! python3 -c "import yaml" &> /dev/null; then
     pacman -S --noconfirm python-yaml
     echo -e "${GREEN}PyYAML 安装完成！${NC}"